@@ -3,63 +3,59 @@
 """\
 Create an Excel spreadsheet for the customer to fill in.
 
-This runs on the SRM server wherre the alerting backend is installed
-and creates a list of Python instructions to create the spreadsheet.
-This allows us to avoid installing extraneous modules on the
-SRM server."""
+This runs on the SRM server wherre the alerting backend is installed.
+If xlsxwriter is available, the spreadsheet is written directly; otherwise
+(or with --emit-code) a list of Python instructions to create the
+spreadsheet is printed instead.  This allows us to avoid installing
+extraneous modules on the SRM server."""
 
 # Insure maximum compatibility between Python 2.6 (installed on the
 # SRM servers) and Python 3 (which may become the default someday).
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-from contextlib import contextmanager
 from glob import glob
-from os import chdir, getcwd
-from os.path import join
+from optparse import OptionParser
+from os import listdir
+from os.path import isdir, join
 
 import re
+import sys
 
 root = "/opt/APG/Web-Servers/Tomcat/Default/webapps/centralized-management/solutionpacks"
 
-@contextmanager
-def pushd(dirname=None):
-    curdir = getcwd()
-    try:
-        if dirname:
-            chdir(dirname)
-        yield
-    finally:
-        chdir(curdir)
+elsefi_re = re.compile(r"\s*(else|fi)\s*$")
+# Either a declaration ("var = type") or a section reference ("name *").
+line_re = re.compile(
+    r"\s*(?:(?P<var>\w+)\s*\=\s*(?P<type>.*?)|(?P<section>\w+(?:\.\w+)*)(?P<flag>\s+\*)?)\s*$")
+section_re = re.compile(r"\s*\[\s*(\W)?(\w+(?:\.\w+)*)\s*\]\s*$")
 
-def interpret(
-    q, section, prefix="",
-    elsefi_re = re.compile(r"\s*(else|fi)\s*$"),
-    star_re = re.compile(r"\s*(\w+(?:\.\w+)*)(\s+\*)?\s*$"),
-    decl_re = re.compile(r"\s*(\w+)\s*\=\s*(.*?)\s*$"),
-    ):
+def interpret(q, section, prefix=""):
     # TODO: Look into Oracle's 'database' section and IBM XIV's 'ibmxiv.array'
-    seen = set()
-    try:
-        iterator = q[section]
-    except KeyError:
+    if section not in q:
         return
-    for line in iterator:
-        match = elsefi_re.match(line)
-        if match:
-            continue
-        match = decl_re.match(line)
-        if match:
-            var, type = match.groups()
-            if prefix:
-                var = prefix + "." + var
-            if var not in seen:
+    # Each frame is a section being read: its name, its remaining lines,
+    # the prefix for its variables, and the names already seen in it.
+    stack = [(section, iter(q[section]), prefix, set())]
+    active = set([section])
+    while stack:
+        current, iterator, prefix, seen = stack[-1]
+        for line in iterator:
+            match = elsefi_re.match(line)
+            if match:
+                continue
+            match = line_re.match(line)
+            if not match:
+                continue
+            var = match.group("var")
+            if var:
                 if prefix:
-                    yield var
-                seen.add(var)
-            continue
-        match = star_re.match(line)
-        if match:
-            section, flag = match.groups()
+                    var = prefix + "." + var
+                if var not in seen:
+                    if prefix:
+                        yield var
+                    seen.add(var)
+                continue
+            section, flag = match.group("section", "flag")
             if flag or prefix:
                 if prefix:
                     new_prefix = prefix + "." + section
@@ -67,37 +63,41 @@ def interpret(
                     new_prefix = section
                 if section not in seen:
                     seen.add(section)
-                    for xxx in interpret(q, section, prefix=new_prefix):
-                        yield xxx
-            continue
+                    if section in q:
+                        if section in active:
+                            raise ValueError("recursive section %r" % section)
+                        # Descend now; this frame resumes where it left off.
+                        stack.append((section, iter(q[section]), new_prefix, set()))
+                        active.add(section)
+                        break
+        else:
+            stack.pop()
+            active.discard(current)
 
 def load_properties(fname):
     """Load a simplified Java-style properties file."""
     properties = {}
     try:
-        with open(fname) as pfile:
+        with open(fname, "rb") as pfile:
             for line in pfile:
-                try:
-                    key, value = map(unicode.strip, line.split("=", 2))
-                    properties[key] = value
-                except ValueError:
-                    pass
+                i = line.find(b"=")
+                if i < 0:
+                    continue
+                key = line[:i].strip().decode("latin-1")
+                properties[key] = line[i+1:].strip().decode("latin-1")
     except IOError:
         pass
     return properties
 
-def load_dialog(fname,
-    section_re = re.compile(r"\s*\[\s*(\W)?(\w+(?:\.\w+)*)\s*\]\s*$"),
-    blank_re = re.compile(r"\s*$"),
-    ):
+def load_dialog(fname):
     """Load a dialog description file."""
     dialog = { "": [] }
-    with open(fname) as dfile:
+    with open(fname, "rb") as dfile:
         section = ""
         for line in dfile:
-            match = blank_re.match(line)
-            if match:
+            if not line.strip():
                 continue
+            line = line.decode("latin-1")
             match = section_re.match(line)
             if match:
                 section = match.group(2)
@@ -106,41 +106,79 @@ def load_dialog(fname,
             dialog[section].append(line)
     return dialog
 
+def collect_sheets(families):
+    """Yield a (sheet name, captions) pair for each collector block."""
+    for dir in listdir(root):
+        ##if not dir.startswith("emc-vnx"):
+            ##continue
+        if dir.startswith("."):
+            continue
+        path = join(root, dir)
+        if not isdir(path):
+            continue
+        meta = load_properties(join(path, "meta.properties"))
+        if meta.get("family") in families:
+            extracted = join(path, "blocks", "extracted")
+            collect = glob(join(extracted, "*collect*"))
+            if len(collect):
+                name = meta["name"]
+                for char in ":\\/?*[]":
+                    name = name.replace(char, "")
+                name = name[:31]
+                xlate = load_properties(join(collect[0], "questions.properties"))
+                questions = load_dialog(join(collect[0], "questions.txt"))
+                captions = []
+                try:
+                    for xxx in interpret(questions, "main"):
+                        caption = xlate.get(xxx)
+                        if not caption:
+                            caption = xlate.get(xxx.split(".")[-1], xxx)
+                        captions.append(caption)
+                except:
+                    from traceback import print_exc
+                    print_exc()
+                    print(collect[0], file=sys.stderr)
+                yield name, captions
+
+def emit_code(sheets, fname):
+    """Print Python instructions that create the spreadsheet."""
+    print("import xlsxwriter")
+    print("wb = xlsxwriter.Workbook(%r, {'constant_memory': True, 'use_zip64': True})" % fname)
+    for name, captions in sheets:
+        print("ws = wb.add_worksheet(%r)" % name)
+        print("ws.write_row(0, 0, %r)" % (captions,))
+    print("wb.close()")
+
+def write_workbook(sheets, fname):
+    """Create the spreadsheet in-process."""
+    import xlsxwriter
+    wb = xlsxwriter.Workbook(fname, {'constant_memory': True, 'use_zip64': True})
+    try:
+        for name, captions in sheets:
+            ws = wb.add_worksheet(name)
+            ws.write_row(0, 0, captions)
+    finally:
+        wb.close()
+
 def main():
-    print("import xlwt")
-    print("wb = xlwt.Workbook()")
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-e", "--emit-code", action="store_true", default=False,
+        help="print Python instructions instead of writing the spreadsheet")
+    options, args = parser.parse_args()
+    if args:
+        parser.error("unexpected arguments: %s" % " ".join(args))
+    if not options.emit_code:
+        try:
+            __import__("xlsxwriter")
+        except ImportError:
+            options.emit_code = True
     families = set(["Application", "Networking", "Infrastructure", "Storage"])
     families = set(["Storage"])
-    chdir(root)
-    for dir in glob("*"):  # TODO: replace with opendir(".")?
-        ##if not dir.startswith("emc-vnx"):
-            ##continue
-        with pushd(dir):
-            meta = load_properties("meta.properties")
-            if meta.get("family") in families:
-                with pushd(join("blocks", "extracted")):
-                    collect = glob("*collect*")
-                    if len(collect):
-                        name = meta["name"]
-                        for char in ":\\/?*[]":
-                            name = name.replace(char, "")
-                        name = name[:31]
-                        print("ws = wb.add_sheet(%r)" % name)
-                        with pushd(collect[0]):
-                            xlate = load_properties("questions.properties")
-                            questions = load_dialog("questions.txt")
-                            try:
-                                for col, xxx in enumerate(interpret(questions, "main")):
-                                    caption = xlate.get(xxx)
-                                    if not caption:
-                                        caption = xlate.get(xxx.split(".")[-1], xxx)
-                                    print("ws.write(0, %d, %r)" % (col, caption))
-                            except:
-                                from traceback import print_exc
-                                print_exc()
-                                print(join(root, dir, "blocks", "extracted", collect[0]))
-                                pass
-    print("wb.save(%r)" % "device-discovery.xls")
+    sheets = collect_sheets(families)
+    if options.emit_code:
+        emit_code(sheets, "device-discovery.xlsx")
+    else:
+        write_workbook(sheets, "device-discovery.xlsx")
 
 if __name__ == "__main__":
     main()